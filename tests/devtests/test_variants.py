@@ -1,7 +1,6 @@
 import covasim as cv
 import sciris as sc
 import numpy as np
-import covasim.utils as cvu
 
 do_plot = 1
 do_show = 0
@@ -73,14 +72,14 @@ def test_efficacy(do_plot=False, do_show=True, do_save=False):
     people0 = snap.get(d1)
     people1 = sim.people
 
-    trial_arm_size = len(cvu.true(people0.n_infections>0))
-    control_arm_size = len(cvu.true(people0.n_infections==0))
+    trial_arm_size = np.count_nonzero(people0.n_infections>0)
+    control_arm_size = np.count_nonzero(people0.n_infections==0)
 
-    trial_not_infected = len(cvu.true((people0.n_infections > 0) * (people1.n_infections == people0.n_infections)))
-    trial_infected = len(cvu.true((people0.n_infections > 0) * (people1.n_infections > people0.n_infections)))
+    trial_not_infected = np.count_nonzero((people0.n_infections > 0) & (people1.n_infections == people0.n_infections))
+    trial_infected = np.count_nonzero((people0.n_infections > 0) & (people1.n_infections > people0.n_infections))
 
-    control_not_infected = len(cvu.true((people0.n_infections == 0) * (people1.n_infections == 0)))
-    control_infected = len(cvu.true((people0.n_infections == 0) * (people1.n_infections > 0)))
+    control_not_infected = np.count_nonzero((people0.n_infections == 0) & (people1.n_infections == 0))
+    control_infected = np.count_nonzero((people0.n_infections == 0) & (people1.n_infections > 0))
 
     p_inf_trial = trial_infected/trial_arm_size
     p_inf_control = control_infected/control_arm_size
@@ -392,22 +391,30 @@ def test_waning_vs_not(do_plot=False, do_show=True, do_save=False):
 def vacc_subtarg(sim):
     ''' Subtarget by age'''
 
+    # Store the days as an array the first time this is called
+    if not hasattr(sim, '_vx_days'):
+        sim._vx_days = np.asarray(sim.vxsubtarg.days)
+
+    # Likewise allocate the mask, reallocating it if the population has changed size
+    if getattr(sim, '_vx_mask', None) is None or sim._vx_mask.size != len(sim.people):
+        sim._vx_mask = np.empty(len(sim.people), dtype=bool)
+
     # retrieves the first ind that is = or < sim.t
-    ind = get_ind_of_min_value(sim.vxsubtarg.days, sim.t)
+    ind = get_ind_of_min_value(sim._vx_days, sim.t)
     age = sim.vxsubtarg.age[ind]
     prob = sim.vxsubtarg.prob[ind]
-    inds = sc.findinds((sim.people.age>=age) * ~sim.people.vaccinated)
-    vals = prob*np.ones(len(inds))
+    mask = sim._vx_mask
+    np.greater_equal(sim.people.age, age, out=mask)
+    mask[sim.people.vaccinated] = False # Clear in place, rather than allocating ~vaccinated
+    inds = np.flatnonzero(mask)
+    vals = np.full(inds.size, prob)
     return {'inds':inds, 'vals':vals}
 
 
-def get_ind_of_min_value(list, time):
-    ind = None
-    for place, t in enumerate(list):
-        if time >= t:
-            ind = place
-
-    if ind is None:
+def get_ind_of_min_value(days, time):
+    ''' Find the index of the last day that is <= time; days must be sorted '''
+    ind = int(np.searchsorted(days, time, side='right') - 1)
+    if ind < 0:
         errormsg = f'{time} is not within the list of times'
         raise ValueError(errormsg)
     return ind